@@ -1,141 +1,312 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import orjson
 import datetime
+import dbm
+from collections import Counter
 from dateutil.relativedelta import relativedelta
 
 BASE_URL = "https://app.asana.com/api/1.0"
 
+SLACK_URL = os.environ['slack_url']
+SLACK_CHANNEL_ID = os.environ['channel_id']
+SLACK_SECTION_LIMIT = 3000  # Max characters of text in a section block
+SLACK_MAX_BLOCKS = 50  # Max blocks in one message
+SLACK_HEADERS = {"Content-Type": "application/json", "Authorization": f"Bearer {os.environ['slack_token']}"}
+# Only retry a post Slack rejected with 429; a read timeout may mean the message was
+# already delivered, so read and other errors are never retried
+SLACK_RETRY = Retry(
+    total=3,
+    connect=3,
+    read=0,
+    other=0,
+    status_forcelist=[429],
+    allowed_methods=frozenset(["POST"]),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
 
 class AsanaAPI:
+    # Union of the fields every report reads, so one walk of the section serves them all.
+    # Only the custom field name and display value are needed (gid is always returned).
+    TASK_OPT_FIELDS = "completed,created_at,assignee.name,custom_fields.name,custom_fields.display_value"
+    # Asana's maximum page size; fewer pages means fewer round-trips
+    PAGE_SIZE = 100
+
     def __init__(self):
         """Initialize Asana API with environment variables"""
         self.token = os.getenv("ASANA_ACCESS_TOKEN")
         self.section_id = os.getenv("ASANA_SECTION_ID")
         self.team_name = os.getenv("ASANA_TEAM_NAME", "Engagement")  # Default: "Engagement"
         self.priority_field = os.getenv("ASANA_PRIORITY_FIELD", "Priority")  # Default: "Priority"
+        # ETag page cache. It holds the section's unfiltered task data for every team, so it is
+        # created owner-only and stored as JSON (never unpickled); point it somewhere private.
+        self.cache_path = os.getenv("ASANA_CACHE_PATH", ".asana_cache")  # Default: ".asana_cache"
 
         if not self.token:
             raise ValueError("ASANA_ACCESS_TOKEN is required in environment variables")
         if not self.section_id:
             raise ValueError("ASANA_SECTION_ID is required in environment variables")
 
-        self.headers = {"Authorization": f"Bearer {self.token}"}
+        # Every report needs either incomplete tasks or tasks created this month, and a task
+        # created this month can only have been completed this month, so let Asana drop the rest
+        self.completed_since = datetime.datetime.utcnow().strftime("%Y-%m-01T00:00:00Z")
+        self._tasks_cache = None
+
+        # Custom field GIDs, resolved by name from the first tasks fetched
+        self._team_field_gid = None
+        self._tag_field_gid = None
+        self._priority_field_gid = None
+        self._wanted_field_gids = {None}
+        # Team/tag/Priority fields of each fetched task, keyed by task gid, so the
+        # reports reuse the index built during the fetch instead of rescanning
+        self._fields_by_task_gid = {}
+
+        # One pooled session for every request so keep-alive is reused across pages
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {self.token}"})
+        self.session.mount("https://", HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=20,
+            # Retry rate limits and transient 5xx in the pool, waiting out Asana's Retry-After;
+            # once retries are exhausted the status check in fetch_tasks_with_pagination reports it
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                respect_retry_after_header=True,
+                allowed_methods=frozenset(["GET"]),
+                raise_on_status=False,
+            ),
+        ))
+        # The Slack post shares this session; its longer prefix takes precedence over https://
+        self.session.mount(SLACK_URL, HTTPAdapter(max_retries=SLACK_RETRY))
+
+    def close(self):
+        """Release pooled connections"""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def fetch_tasks_with_pagination(self, url):
-        """Fetch tasks from Asana with pagination"""
-        all_tasks = []
-
-        while url:
-            response = requests.get(url, headers=self.headers)
-            if response.status_code != 200:
-                raise Exception(f"API request failed: {response.status_code}")
-
-            data = response.json()
-            tasks = data.get("data", [])
-
-            # Filter tasks where Team == ASANA_TEAM_NAME and tag != "Not a bug"
-            for task in tasks:
-                team_matches = False
-                tag_is_not_bug = False
-                
-                for field in task.get("custom_fields", []):
-                    if field.get("name") == "Team" and field.get("display_value") == self.team_name:
-                        team_matches = True
-                    elif field.get("name") == "tag" and field.get("display_value") != "Not a bug":
-                        tag_is_not_bug = True
-                
-                # Only include task if both conditions are met
-                if team_matches and tag_is_not_bug:
-                    all_tasks.append(task)
-
-            # Handle pagination
-            next_page = data.get("next_page")
-            if next_page:
-                url = f"{BASE_URL}/sections/{self.section_id}/tasks?opt_fields=custom_fields,created_at,completed,assignee.name&offset={next_page['offset']}&limit=50"
-            else:
-                url = ""
-
-        return all_tasks
-
-    def get_pending_tasks(self):
-        """Fetch the number of incomplete tasks in a section"""
-        url = f"{BASE_URL}/sections/{self.section_id}/tasks?limit=50&opt_fields=completed,custom_fields,assignee.name,created_at"
-        tasks = self.fetch_tasks_with_pagination(url)
-        return sum(1 for task in tasks if not task.get("completed", False))
-
-    def get_incoming_tasks_grouped_by_priority(self):
-        """Fetch tasks created this month and group them by Priority"""
-        url = f"{BASE_URL}/sections/{self.section_id}/tasks?limit=50&opt_fields=custom_fields,created_at"
-        tasks = self.fetch_tasks_with_pagination(url)
+        """Fetch tasks from Asana with pagination, yielding matching tasks page by page"""
+        # Pages from previous runs keyed by URL, as (etag, page), for conditional requests
+        page_cache = self._open_page_cache()
+        fetched_pages = {}
+        try:
+            while url:
+                cached = self._cached_page(page_cache, url)
+                headers = {"If-None-Match": cached[0]} if cached else None
+
+                response = self.session.get(url, headers=headers, timeout=30)
+                if response.status_code == 304:
+                    # Page unchanged since the last run; reuse it and skip the download
+                    data = cached[1]
+                    fetched_pages[url] = cached
+                elif response.status_code != 200:
+                    raise Exception(f"API request failed: {response.status_code}")
+                else:
+                    data = orjson.loads(response.content)
+                    etag = response.headers.get("ETag")
+                    if etag:
+                        fetched_pages[url] = (etag, data)
+                tasks = data.get("data", [])
+
+                # Filter tasks where Team == ASANA_TEAM_NAME and tag != "Not a bug"
+                for task in tasks:
+                    fields = self._index_custom_fields(task)
+
+                    team_field = fields.get(self._team_field_gid)
+                    tag_field = fields.get(self._tag_field_gid)
+                    team_matches = team_field is not None and team_field.get("display_value") == self.team_name
+                    tag_is_not_bug = tag_field is not None and tag_field.get("display_value") != "Not a bug"
+
+                    # Only include task if both conditions are met
+                    if team_matches and tag_is_not_bug:
+                        if task.get("gid") is not None:
+                            self._fields_by_task_gid[task["gid"]] = fields
+                        yield task
+
+                # Handle pagination
+                # Asana's next_page uri already carries the caller's query (opt_fields, limit, ...)
+                next_page = data.get("next_page")
+                if next_page:
+                    url = next_page["uri"]
+                else:
+                    url = ""
+        finally:
+            if page_cache is not None:
+                page_cache.close()
+
+        # Only a complete walk replaces the cache, which drops last month's URLs and old offsets
+        if page_cache is not None:
+            self._save_page_cache(fetched_pages)
+
+    def _open_page_cache(self):
+        """Open the ETag page cache, or return None so the fetch runs uncached"""
+        try:
+            return dbm.open(self.cache_path, "c", 0o600)
+        except Exception as e:
+            # e.g. a read-only working directory or a concurrent run holding the dbm lock
+            print(f"⚠️ Page cache disabled, could not open {self.cache_path}: {e}")
+            return None
+
+    def _cached_page(self, page_cache, url):
+        """Return the cached (etag, page) for a URL, or None if it is missing or unreadable"""
+        if page_cache is None:
+            return None
+
+        try:
+            entry = orjson.loads(page_cache[url])
+            etag, page = entry["etag"], entry["page"]
+        except Exception:
+            # Missing, truncated or foreign entries count as misses; the rewrite replaces them
+            return None
+
+        if not isinstance(etag, str) or not isinstance(page, dict):
+            return None
+        return etag, page
+
+    def _save_page_cache(self, pages):
+        """Rewrite the ETag page cache so it holds only the given pages"""
+        try:
+            with dbm.open(self.cache_path, "n", 0o600) as page_cache:
+                for url, (etag, page) in pages.items():
+                    page_cache[url] = orjson.dumps({"etag": etag, "page": page})
+        except Exception as e:
+            print(f"⚠️ Could not update page cache {self.cache_path}: {e}")
+
+    def _resolve_field_gids(self, custom_fields):
+        """Remember the GIDs of the Team, tag and Priority custom fields"""
+        # Keep the first match per name; a multi-project task can carry a second,
+        # project-local field of the same name that must not replace it
+        for field in custom_fields:
+            name = field.get("name")
+            if name == "Team" and self._team_field_gid is None:
+                self._team_field_gid = field.get("gid")
+            elif name == "tag" and self._tag_field_gid is None:
+                self._tag_field_gid = field.get("gid")
+            elif name == self.priority_field and self._priority_field_gid is None:
+                self._priority_field_gid = field.get("gid")
+
+            if None not in (self._team_field_gid, self._tag_field_gid, self._priority_field_gid):
+                break
+
+        self._wanted_field_gids = {self._team_field_gid, self._tag_field_gid, self._priority_field_gid}
+
+    def _index_custom_fields(self, task):
+        """Index the Team, tag and Priority fields of a task by GID so each lookup is a single dict access"""
+        custom_fields = task.get("custom_fields", [])
+        if None in (self._team_field_gid, self._tag_field_gid, self._priority_field_gid):
+            self._resolve_field_gids(custom_fields)
+
+        wanted = self._wanted_field_gids
+        fields = {}
+        for field in custom_fields:
+            gid = field.get("gid")
+            if gid in wanted:
+                fields[gid] = field
+                # Stop scanning as soon as all three fields are found
+                if len(fields) == len(wanted):
+                    break
+
+        return fields
+
+    def _tasks_url(self):
+        """Build the URL for the first page of section tasks"""
+        return (
+            f"{BASE_URL}/sections/{self.section_id}/tasks?limit={self.PAGE_SIZE}"
+            f"&opt_fields={self.TASK_OPT_FIELDS}&completed_since={self.completed_since}"
+        )
+
+    def _load_tasks(self):
+        """Fetch the section's tasks once and reuse them for every report"""
+        if self._tasks_cache is None:
+            self._tasks_cache = list(self.fetch_tasks_with_pagination(self._tasks_url()))
+        return self._tasks_cache
+
+    def compute_all_reports(self, tasks=None):
+        """Build every report in a single pass over the tasks"""
+        if tasks is None:
+            tasks = self._load_tasks()
 
         current_month = datetime.datetime.utcnow().strftime("%Y-%m")
-        priority_counts = {}
+        pending_count = 0
+        incoming_priority_counts = Counter()
+        priority_counts = Counter()
+        assignee_counts = Counter()
 
         for task in tasks:
-            created_at = task.get("created_at")
-            if not created_at:
-                continue
+            fields = self._fields_by_task_gid.get(task.get("gid"))
+            if fields is None:
+                fields = self._index_custom_fields(task)
+            priority_field = fields.get(self._priority_field_gid)
+            priority = priority_field.get("display_value", "Unknown") if priority_field is not None else None
 
-            task_date = datetime.datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%S.%fZ")
-            if task_date.strftime("%Y-%m") != current_month:
-                continue
-
-            for field in task.get("custom_fields", []):
-                if field.get("name") == self.priority_field:
-                    priority_counts[field.get("display_value", "Unknown")] = (
-                            priority_counts.get(field.get("display_value", "Unknown"), 0) + 1
-                    )
-
-        return sorted(priority_counts.items(), key=lambda x: x[1], reverse=True)
-
-    def get_tasks_grouped_by_priority(self):
-        """Fetch tasks and group them by Priority (ONLY INCOMPLETE TASKS)"""
-        url = f"{BASE_URL}/sections/{self.section_id}/tasks?limit=50&opt_fields=custom_fields,completed"
-        tasks = self.fetch_tasks_with_pagination(url)
-
-        priority_counts = {}
+            # created_at is ISO-8601 (YYYY-MM-DDTHH:MM:SS.fffZ), so its prefix is the month
+            created_at = task.get("created_at")
+            if created_at and priority_field is not None and created_at.startswith(current_month):
+                incoming_priority_counts[priority] += 1
 
-        for task in tasks:
+            # The remaining reports only count incomplete tasks
             if task.get("completed", False):
                 continue
 
-            for field in task.get("custom_fields", []):
-                if field.get("name") == self.priority_field:
-                    priority_counts[field.get("display_value", "Unknown")] = (
-                            priority_counts.get(field.get("display_value", "Unknown"), 0) + 1
-                    )
-
-        return priority_counts
-
-    def get_tasks_grouped_by_assignee(self):
-        """Fetch tasks and group them by Assignee (ONLY INCOMPLETE TASKS)"""
-        url = f"{BASE_URL}/sections/{self.section_id}/tasks?limit=50&opt_fields=custom_fields,created_at,assignee.name,completed"
-        tasks = self.fetch_tasks_with_pagination(url)
-
-        assignee_counts = {}
-
-        for task in tasks:
-            if task.get("completed", False):
-                continue
+            pending_count += 1
+            if priority_field is not None:
+                priority_counts[priority] += 1
 
             assignee = task.get("assignee") or {}
-            assignee_name = assignee.get("name", "Unassigned")  # Default: "Unassigned"
-
-            assignee_counts[assignee_name] = assignee_counts.get(assignee_name, 0) + 1
-
-        return sorted(assignee_counts.items(), key=lambda x: x[1], reverse=True)
-
-
-def send_slack_message(slack_message):
+            assignee_counts[assignee.get("name", "Unassigned")] += 1  # Default: "Unassigned"
+
+        return {
+            "pending": pending_count,
+            "incoming_by_priority": incoming_priority_counts.most_common(),
+            "by_priority": priority_counts.most_common(),
+            "by_assignee": assignee_counts.most_common(),
+        }
+
+
+def section_blocks(text):
+    """Split report text into mrkdwn section blocks within Slack's per-section limit"""
+    chunks = []
+    lines = []
+    length = 0
+    for line in text.splitlines(keepends=True):
+        line = line[:SLACK_SECTION_LIMIT]  # A single oversized line is truncated
+        if lines and length + len(line) > SLACK_SECTION_LIMIT:
+            chunks.append("".join(lines))
+            lines = []
+            length = 0
+        lines.append(line)
+        length += len(line)
+    if lines:
+        chunks.append("".join(lines))
+
+    return [{"type": "section", "text": {"type": "mrkdwn", "text": chunk}} for chunk in chunks]
+
+
+def send_slack_message(session, title, sections):
+    """Post the report to Slack as a single Block Kit message"""
     payload = {
-        "channel": os.environ['channel_id'],
-        "text": slack_message
+        "channel": SLACK_CHANNEL_ID,
+        "text": title + " \n\n" + "\n".join(sections)  # Fallback for notifications
     }
-    slack_url = os.environ['slack_url']
-    slack_headers = {"Content-Type": "application/json", "Authorization": f"Bearer {os.environ['slack_token']}"}
+    blocks = [block for text in [title, *sections] for block in section_blocks(text)]
+    # Past Slack's block cap, post the plain text body alone rather than fail the whole message
+    if len(blocks) <= SLACK_MAX_BLOCKS:
+        payload["blocks"] = blocks
 
-    response = requests.post(slack_url, headers=slack_headers, json=payload)
+    # Posted through the Asana session, which has the Slack retry adapter mounted
+    response = session.post(SLACK_URL, headers=SLACK_HEADERS, data=orjson.dumps(payload), timeout=30)
 
     if response.status_code == 200:
         response_data = response.json()
@@ -148,45 +319,34 @@ def send_slack_message(slack_message):
 
 def main():
     """Main function to execute the Asana API queries"""
-    asana_api = AsanaAPI()
+    sections = []
+
+    with AsanaAPI() as asana_api:
+        try:
+            # One pass over the cached tasks builds every report
+            reports = asana_api.compute_all_reports()
+        except Exception as e:
+            sections.append(f"⚠️ Error fetching tasks: {e}\n")
+        else:
+            sections.append(f"📌 *Pending Tasks:* {reports['pending']}\n")
 
-    slack_message = ""
+            lines = ["📥 *Incoming Tasks ("+ datetime.datetime.utcnow().strftime("%Y-%m") + ") grouped by Priority:*\n"]
+            if not reports["incoming_by_priority"]:
+                lines.append("   - 0\n")
+            else:
+                lines.extend(f"   - {priority}: {count}\n" for priority, count in reports["incoming_by_priority"])
+            sections.append("".join(lines))
 
-    try:
-        pending_tasks = asana_api.get_pending_tasks()
-        slack_message += f"📌 *Pending Tasks:* {pending_tasks}\n"
-    except Exception as e:
-        slack_message += f"⚠️ Error fetching pending tasks: {e}\n"
+            lines = ["🔥 *Tasks grouped by Priority:*\n"]
+            lines.extend(f"   - {priority}: {count}\n" for priority, count in reports["by_priority"])
+            sections.append("".join(lines))
 
-    try:
-        incoming_priority_tasks = asana_api.get_incoming_tasks_grouped_by_priority()
-        slack_message += "\n📥 *Incoming Tasks ("+ datetime.datetime.utcnow().strftime("%Y-%m") + ") grouped by Priority:*\n"
-        if not incoming_priority_tasks:
-            slack_message += "   - 0\n"
-        else:
-            for priority, count in incoming_priority_tasks:
-                slack_message += f"   - {priority}: {count}\n"
-    except Exception as e:
-        slack_message += f"⚠️ Error fetching incoming tasks by priority: {e}\n"
-
-    try:
-        priority_tasks = asana_api.get_tasks_grouped_by_priority()
-        slack_message += "\n🔥 *Tasks grouped by Priority:*\n"
-        for priority, count in priority_tasks.items():
-            slack_message += f"   - {priority}: {count}\n"
-    except Exception as e:
-        slack_message += f"⚠️ Error fetching tasks by priority: {e}\n"
-
-    try:
-        assignee_tasks = asana_api.get_tasks_grouped_by_assignee()
-        slack_message += "\n👥 *Tasks grouped by Assignee:*\n"
-        for assignee, count in assignee_tasks:
-            slack_message += f"   - {assignee}: {count}\n"
-    except Exception as e:
-        slack_message += f"⚠️ Error fetching tasks by assignee: {e}\n"
-
-    # Send Slack message
-    send_slack_message("*Asana Status* \n\n" + slack_message)
+            lines = ["👥 *Tasks grouped by Assignee:*\n"]
+            lines.extend(f"   - {assignee}: {count}\n" for assignee, count in reports["by_assignee"])
+            sections.append("".join(lines))
+
+        # Send Slack message
+        send_slack_message(asana_api.session, "*Asana Status*", sections)
 
 
 if __name__ == "__main__":